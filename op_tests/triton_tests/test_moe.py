@@ -1,7 +1,10 @@
 # SPDX-License-Identifier: MIT
 # Copyright (C) 2024-2025, Advanced Micro Devices, Inc. All rights reserved.
 
+import functools
+import os
 import torch
+import torch.nn.functional as F
 import pytest
 from typing import Dict
 
@@ -22,12 +25,38 @@ from aiter.ops.triton.moe_op_gelu import (
     moe_set_use_persistent_kernel as triton_moe_gelu_set_use_persistent_kernel,
 )
 
+from aiter.ops.triton.quant import dynamic_per_tensor_quant_fp8_i8
 from aiter.ops.triton.utils.moe_config_utils import get_optimal_moe_config_func
 from aiter.ops.triton.utils.types import torch_to_triton_dtype
+from op_tests.triton_tests.test_moe_align_block_size import (
+    triton_moe_align_block_size,
+)
 
 DEBUG_MODE = False
+if DEBUG_MODE:
+    torch.set_printoptions(threshold=100000)
+# Set to run the torch references fully eagerly, e.g. when debugging them.
+AITER_NO_COMPILE = os.environ.get("AITER_NO_COMPILE", "0") == "1"
+# Set to compute each e2e torch reference once per input set and reuse it for
+# the parametrizations that only differ in kernel flags.
+AITER_TEST_REF_CACHE = os.environ.get("AITER_TEST_REF_CACHE", "0") == "1"
+# Set to quantize the fp8 reference activations with the Triton per-tensor
+# quant kernel instead of quantize_fp8.
+AITER_TRITON_REF_QUANT = os.environ.get("AITER_TRITON_REF_QUANT", "0") == "1"
+
 
+def _maybe_compile(fn):
+    """
+    Fuses the elementwise reference helpers with torch.compile unless
+    AITER_NO_COMPILE is set. The GEMM parts of the references stay eager as
+    their per-expert loops would only cause graph breaks.
+    """
+    if AITER_NO_COMPILE:
+        return fn
+    return torch.compile(fn, dynamic=True)
 
+
+@_maybe_compile
 def torch_silu_and_mul_ref(input):
     """
     Performs the SiLU activation on the first half of the input tensor and
@@ -38,15 +67,118 @@ def torch_silu_and_mul_ref(input):
     Returns:
         torch.Tensor: Output tensor of shape [..., d].
     """
-    dtype = input.dtype
     d = input.size(-1) // 2
-    A, B = input[:, :d], input[:, d:]
+    A, B = input[..., :d], input[..., d:]
+
+    return F.silu(A).mul_(B)
+
+
+@_maybe_compile
+def _gelu_tanh(c):
+    return 0.5 * c * (1.0 + torch.tanh(0.7978845608 * (c + 0.044715 * c * c * c)))
+
+
+def _scaled_mm(a, b, scale_a, scale_b, out_dtype):
+    """
+    Computes (a @ b.T) * scale_a * scale_b for fp8 a and b, using the fused
+    fp8 GEMM when the device and shapes allow it.
+    """
+    try:
+        return torch._scaled_mm(
+            a, b.t(), scale_a=scale_a, scale_b=scale_b, out_dtype=out_dtype
+        )
+    except RuntimeError:
+        # Accumulate in fp32, raw fp8 products overflow fp16 before scaling
+        return (a.float() @ b.float().t() * scale_a * scale_b).to(out_dtype)
+
+
+def _grouped_expert_mm(
+    a, b, flat_ids, top_k, num_experts, a_scale=None, b_scale=None, out_dtype=None
+):
+    """
+    Multiplies every token of a with the weights of each expert it is routed
+    to. Slots are grouped by expert so that each b[e] is read by a single GEMM
+    instead of being gathered once per routed token.
+    Args:
+        a (torch.Tensor): Input tensor of shape [M, K].
+        b (torch.Tensor): Expert weights of shape [E, N, K].
+        flat_ids (torch.Tensor): Expert index of each (token, slot) pair,
+            flattened to shape [M * top_k].
+        top_k (int): Number of experts each token is routed to.
+        num_experts (int): Number of experts E.
+        a_scale (torch.Tensor, optional): Per-tensor dequant scale of fp8 a.
+        b_scale (torch.Tensor, optional): Per-expert dequant scales of b,
+            shape [E]. Applied to each expert's output as it is computed.
+        out_dtype (torch.dtype, optional): Output dtype, defaults to a.dtype.
+    Returns:
+        torch.Tensor: Output tensor of shape [M * top_k, N].
+    """
+    order = torch.argsort(flat_ids, stable=True)
+    counts = torch.bincount(flat_ids, minlength=num_experts)
+    # Gather straight from a, rows shared by several slots are not repeated
+    a_sorted = a.index_select(0, order // top_k)
+
+    out_sorted = _sorted_expert_mm(a_sorted, b, counts, a_scale, b_scale, out_dtype)
+
+    # Undo the grouping
+    return torch.empty_like(out_sorted).index_copy_(0, order, out_sorted)
+
+
+def _sorted_expert_mm(a_sorted, b, counts, a_scale=None, b_scale=None, out_dtype=None):
+    """
+    Same as _grouped_expert_mm for rows that are already grouped by expert,
+    counts[e] being the number of rows routed to expert e. The output keeps
+    the grouped row order.
+    """
+    out_sorted = None
+    if a_scale is None and b_scale is None:
+        out_sorted = _try_grouped_mm(a_sorted, b, counts)
+    if out_sorted is None:
+        out_sorted = _expert_loop_mm(a_sorted, b, counts, a_scale, b_scale, out_dtype)
+    return out_sorted
 
-    silu_A = A / (1.0 + torch.exp(-A.float()))
 
-    output = silu_A * B
+def _try_grouped_mm(a_sorted, b, counts):
+    """
+    Runs all experts' GEMMs as a single torch._grouped_mm call. Returns None
+    when grouped GEMMs are unavailable for this build, device or shape.
+    """
+    if not hasattr(torch, "_grouped_mm") or a_sorted.dtype != torch.bfloat16:
+        return None
+    try:
+        return torch._grouped_mm(
+            a_sorted,
+            b.to(a_sorted.dtype).transpose(1, 2),
+            offs=counts.cumsum(0, dtype=torch.int32),
+        )
+    except RuntimeError:
+        return None
+
+
+def _expert_loop_mm(a_sorted, b, counts, a_scale, b_scale, out_dtype):
+    """
+    Runs one GEMM per expert over the expert-sorted rows of a_sorted.
+    """
+    out_sorted = a_sorted.new_empty(
+        (a_sorted.shape[0], b.shape[1]), dtype=out_dtype or a_sorted.dtype
+    )
+    start = 0
+    for e, count in enumerate(counts.tolist()):
+        if count == 0:
+            continue
+        end = start + count
+        if a_scale is not None:
+            out_sorted[start:end] = _scaled_mm(
+                a_sorted[start:end], b[e], a_scale, b_scale[e], out_sorted.dtype
+            )
+        else:
+            out = a_sorted[start:end] @ b[e].to(a_sorted.dtype).T
+            if b_scale is not None:
+                out *= b_scale[e]
+            out_sorted[start:end] = out
+        start = end
 
-    return output.to(dtype)
+    return out_sorted
 
 
 def torch_moe_ref(
@@ -70,57 +202,43 @@ def torch_moe_ref(
     gelu=False,
 ):
     if fp8_w8a8:
-        a, _, a_scale = quantize_fp8(a)
+        a, a_scale = _quantize_fp8_per_tensor(a)
 
     M, top_k, N = c.shape
     _, K = a.shape
 
     if int4_w4a16:
-        b = torch.repeat_interleave(b, repeats=2, dim=2)  # Expand to (E, N, K)
-        b_shifter = ((torch.arange(0, K, device=b.device) % 2) * 4)[None, None, :]
-        b = (b >> b_shifter) & 0xF
-        b_scale = torch.repeat_interleave(
-            b_scale, repeats=group_size, dim=2
-        )  # (E, N, K)
+        E = b.shape[0]
+        # Unpack (E, N, K//2) -> (E, N, K//group_size, group_size), low nibble first
+        b = torch.stack((b & 0xF, b >> 4), dim=-1)
+        b = b.view(E, N, K // group_size, group_size).int()
         if b_zp is not None:
-            b_zp = torch.repeat_interleave(
-                b_zp, repeats=2, dim=1
-            )  # (E,N//2,K//group_size) -> (E, N, K // group_size)
-            b_zp = torch.repeat_interleave(
-                b_zp, repeats=group_size, dim=2
-            )  # (E,N,K//group_size) -> (E, N, K)
-            b_zp_shifter = ((torch.arange(0, N, device=b.device) % 2) * 4)[
-                None, :, None
-            ]
-            b_zp = (b_zp >> b_zp_shifter) & 0xF
-            b = (b - b_zp) * b_scale
+            # (E, N//2, K//group_size) -> (E, N, K//group_size)
+            b_zp = torch.stack((b_zp & 0xF, b_zp >> 4), dim=2).view(E, N, -1)
+            b = b - b_zp.unsqueeze(-1)
         else:
-            b = (b - 8) * b_scale
+            b = b - 8
+        # Broadcast the scales over each group instead of expanding them
+        b = (b * b_scale.unsqueeze(-1)).view(E, N, K)
 
-    # Repeat a -> (M, top_k, K)
-    a_expanded = a.unsqueeze(1).repeat(1, top_k, 1)
-    # (M, top_k, N, K)
+    flat_ids = topk_ids.reshape(-1)
     if fp8_w8a8:
-        b_indexed = b.half()[topk_ids]
+        c = _grouped_expert_mm(
+            a, b, flat_ids, top_k, b.shape[0], a_scale, b_scale, dtype
+        )
+    elif int8_w8a16:
+        c = _grouped_expert_mm(
+            a.to(dtype), b, flat_ids, top_k, b.shape[0], b_scale=b_scale
+        )
     else:
-        b_indexed = b[topk_ids]
-
-    c = torch.einsum("mek,menk->men", a_expanded.to(dtype), b_indexed.to(dtype))
+        c = _grouped_expert_mm(a.to(dtype), b, flat_ids, top_k, b.shape[0])
+    c = c.view(M, top_k, N)
 
     if routed_weight:
         c *= topk_weights.unsqueeze(-1)
 
     if not routed_weight and gelu:
-        c = 0.5 * c * (1.0 + torch.tanh(0.7978845608 * (c + 0.044715 * c * c * c)))
-
-    if fp8_w8a8:
-        c = c * b_scale[topk_ids].unsqueeze(-1)
-        c = c * a_scale
-        c = c.to(dtype)
-
-    if int8_w8a16:
-        c = c * b_scale[topk_ids].unsqueeze(-1)
-        c = c.to(dtype)
+        c = _gelu_tanh(c)
 
     return c
 
@@ -134,56 +252,39 @@ def _moe_align_block_size(
     expert_ids: torch.Tensor,
     num_tokens_post_pad: torch.Tensor,
 ) -> None:
-    M, top_k = topk_ids.shape
-
-    expert_to_tokens = [[] for _ in range(num_experts)]
-    # For each token, for each selected expert, we append (token_id, expert)
-    for token_id in range(M):
-        for j in range(top_k):
-            e_id = topk_ids[token_id, j].item()
-            expert_to_tokens[e_id].append(token_id * top_k + j)
-
-    # Reorder tokens block by block, padding if needed
-    reordered_token_ids = []
-    reordered_expert_ids = []
-
-    for e_id in range(num_experts):
-        tokens_for_expert = expert_to_tokens[e_id]
-        num_tokens = len(tokens_for_expert)
-
-        n_blocks = (num_tokens + block_size - 1) // block_size
-        # If not a multiple of block_size, pad up to the next multiple
-        padded_size = n_blocks * block_size
-
-        # Reorder all actual tokens for expert e_id
-        reordered_token_ids.extend(tokens_for_expert)
-        # reordered_expert_ids.extend([e_id]*num_tokens)
-        reordered_expert_ids.extend([e_id] * n_blocks)
-
-        # Pad with dummy token_id = topk_ids.numel()
-        if padded_size > num_tokens:
-            pad_count = padded_size - num_tokens
-            reordered_token_ids.extend([topk_ids.numel()] * pad_count)
-
-    token_length = len(reordered_token_ids)
-    expert_length = len(reordered_expert_ids)
-
-    sorted_token_ids[:token_length] = torch.tensor(
-        reordered_token_ids,
-        dtype=sorted_token_ids.dtype,
-        device=sorted_token_ids.device,
-    )
-    expert_ids[:expert_length] = torch.tensor(
-        reordered_expert_ids, dtype=expert_ids.dtype, device=expert_ids.device
-    )
+    flat_ids = topk_ids.reshape(-1)
+    numel = flat_ids.numel()
 
-    # Fill remainder with topk_ids.numel() if these arrays are bigger than total_length
-    if token_length < sorted_token_ids.numel():
-        sorted_token_ids[token_length:] = topk_ids.numel()
-    if expert_length < expert_ids.numel():
-        expert_ids[expert_length:] = topk_ids.numel()
+    # Group the flattened (token_id * top_k + j) slots by expert, keeping token order
+    order = torch.argsort(flat_ids, stable=True)
+    sorted_experts = flat_ids[order]
 
-    num_tokens_post_pad.fill_(token_length)
+    # scatter_add_ rather than bincount, which reads the max id back on CUDA
+    counts = torch.zeros(num_experts, dtype=flat_ids.dtype, device=flat_ids.device)
+    counts.scatter_add_(0, flat_ids, torch.ones_like(flat_ids))
+    n_blocks = (counts + block_size - 1) // block_size
+    # If not a multiple of block_size, pad up to the next multiple
+    padded_counts = n_blocks * block_size
+    starts = torch.cumsum(counts, 0) - counts
+    padded_starts = torch.cumsum(padded_counts, 0) - padded_counts
+
+    # Destination of each slot: start of its padded expert segment + rank in expert
+    rank = torch.arange(numel, device=flat_ids.device) - starts[sorted_experts]
+    dest = padded_starts[sorted_experts] + rank
+
+    # Pad with dummy token_id = topk_ids.numel(), then scatter the actual tokens
+    sorted_token_ids.fill_(numel)
+    sorted_token_ids[dest] = order.to(sorted_token_ids.dtype)
+
+    # Expert of each block = number of expert segments ending at or before it,
+    # computed on device so the output length never has to be read back
+    block_ends = torch.cumsum(n_blocks, 0)
+    block_idx = torch.arange(expert_ids.numel(), device=expert_ids.device)
+    block_experts = torch.searchsorted(block_ends, block_idx, right=True)
+    # Fill remainder with topk_ids.numel() past the last expert's blocks
+    expert_ids.copy_(torch.where(block_idx < block_ends[-1], block_experts, numel))
+
+    num_tokens_post_pad.copy_(padded_counts.sum())
 
 
 def torch_moe_align_block_size_ref(
@@ -243,7 +344,6 @@ def torch_e2e_moe(
     a,
     w1,
     w2,
-    c,
     a_scale,
     w1_scale,
     w2_scale,
@@ -255,57 +355,40 @@ def torch_e2e_moe(
     int8_w8a16,
 ):
     if fp8_w8a8:
-        a, _, a_scale = quantize_fp8(a)
-
-    M, top_k, _ = c.shape
-    E, N, _ = w1.shape
-
-    # Repeat a -> (M, top_k, K)
-    a_expanded = a.unsqueeze(1).repeat(1, top_k, 1)
-    # (M, top_k, N, K)
-    if fp8_w8a8:
-        w1_indexed = w1.half()[topk_ids]
-    else:
-        w1_indexed = w1[topk_ids]
+        a, a_scale = _quantize_fp8_per_tensor(a)
 
-    intermidiate = torch.einsum(
-        "mek,menk->men", a_expanded.to(dtype), w1_indexed.to(dtype)
-    )
-
-    if fp8_w8a8:
-        intermidiate = intermidiate * w1_scale[topk_ids].unsqueeze(-1)
-        intermidiate = intermidiate * a_scale
-        intermidiate = intermidiate.to(dtype)
+    M = a.shape[0]
+    top_k = topk_ids.shape[1]
+    E, _, K = w1.shape
 
-    if int8_w8a16:
-        intermidiate = intermidiate * w1_scale[topk_ids].unsqueeze(-1)
-        intermidiate = intermidiate.to(dtype)
+    # Group the routed rows by expert once and keep them grouped through both
+    # GEMMs and the SiLU, only the final output is put back in token order
+    flat_ids = topk_ids.reshape(-1)
+    order = torch.argsort(flat_ids, stable=True)
+    counts = torch.bincount(flat_ids, minlength=E)
+    if not fp8_w8a8:
+        a = a.to(dtype)
+    a_sorted = a.index_select(0, order // top_k)
 
     if fp8_w8a8:
-        w2_indexed = w2.half()[topk_ids]
+        intermidiate = _sorted_expert_mm(a_sorted, w1, counts, a_scale, w1_scale, dtype)
+    elif int8_w8a16:
+        intermidiate = _sorted_expert_mm(a_sorted, w1, counts, b_scale=w1_scale)
     else:
-        w2_indexed = w2[topk_ids]
-
-    print(intermidiate.shape)
-
-    silu_out = torch.zeros([M * top_k, N // 2], dtype=a.dtype, device=a.device)
-    silu_out = torch_silu_and_mul_ref(intermidiate.view(-1, N))
-
-    silu_out = silu_out.view(M, top_k, N // 2)
-
-    if fp8_w8a8:
-        silu_out, _, silu_out_scale = quantize_fp8(silu_out)
+        intermidiate = _sorted_expert_mm(a_sorted, w1, counts)
 
-    c = torch.einsum("mek,menk->men", silu_out.to(dtype), w2_indexed.to(dtype))
+    silu_out = torch_silu_and_mul_ref(intermidiate)
 
     if fp8_w8a8:
-        c = c * w2_scale[topk_ids].unsqueeze(-1)
-        c = c * silu_out_scale
-        c = c.to(dtype)
+        silu_out, silu_out_scale = _quantize_fp8_per_tensor(silu_out)
+        c = _sorted_expert_mm(silu_out, w2, counts, silu_out_scale, w2_scale, dtype)
+    elif int8_w8a16:
+        c = _sorted_expert_mm(silu_out, w2, counts, b_scale=w2_scale)
+    else:
+        c = _sorted_expert_mm(silu_out, w2, counts)
 
-    if int8_w8a16:
-        c = c * w2_scale[topk_ids].unsqueeze(-1)
-        c = c.to(dtype)
+    # Undo the grouping
+    c = torch.empty_like(c).index_copy_(0, order, c).view(M, top_k, K)
 
     if routed_weight:
         c *= topk_weights.unsqueeze(-1)
@@ -344,9 +427,12 @@ def quantize_fp8(
     tensor: torch.Tensor, dim=()
 ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
     quantize_dim = [i for i in range(tensor.dim()) if i not in dim]
-    max_vals = tensor.abs().amax(dim=quantize_dim, keepdim=True)
+    # Single fused |x| + max reduction
+    max_vals = torch.linalg.vector_norm(
+        tensor, ord=float("inf"), dim=tuple(quantize_dim), keepdim=True
+    )
     max_repr_val = torch.finfo(torch.float8_e4m3fnuz).max
-    max_vals[max_vals == 0] = 1e-8  # Avoid division by zero
+    max_vals.masked_fill_(max_vals == 0, 1e-8)  # Avoid division by zero
 
     # Compute scale factors for each channel
     scale: torch.Tensor = max_repr_val / max_vals.to(torch.float32)
@@ -361,21 +447,39 @@ def quantize_fp8(
     return tensor_quantized, scale, 1 / scale
 
 
+def _quantize_fp8_per_tensor(tensor: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+    """
+    Per-tensor fp8 quantization of the reference activations. Returns the
+    quantized tensor and its dequant scale.
+    """
+    if not AITER_TRITON_REF_QUANT:
+        tensor_quantized, _, scale = quantize_fp8(tensor)
+        return tensor_quantized, scale
+
+    x = tensor.reshape(-1, tensor.shape[-1])
+    qx = torch.empty_like(x, dtype=torch.float8_e4m3fnuz)
+    scale = torch.zeros(1, dtype=torch.float32, device=tensor.device)
+    qx, scale = dynamic_per_tensor_quant_fp8_i8(qx, x, scale)
+    return qx.view(tensor.shape), scale
+
+
 def quantize_int8(
     tensor: torch.Tensor, dim=()
 ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
     quantize_dim = [i for i in range(tensor.dim()) if i not in dim]
-    max_vals = tensor.abs().amax(dim=quantize_dim, keepdim=True)
+    # Single fused |x| + max reduction
+    max_vals = torch.linalg.vector_norm(
+        tensor, ord=float("inf"), dim=tuple(quantize_dim), keepdim=True
+    )
     max_repr_val = torch.iinfo(torch.int8).max
-    max_vals[max_vals == 0] = 1e-8  # Avoid division by zero
+    max_vals.masked_fill_(max_vals == 0, 1e-8)  # Avoid division by zero
 
     # Compute scale factors for each channel
     scale: torch.Tensor = max_repr_val / max_vals.to(torch.float32)
 
     # Quantize the tensor
     tensor = tensor * scale
-    tensor.clamp_(-max_repr_val, max_repr_val)
-    tensor = tensor.round_()
+    tensor.clamp_(-max_repr_val, max_repr_val).round_()
     tensor_quantized = tensor.to(torch.int8)
 
     scale = scale.squeeze(dim=quantize_dim)
@@ -387,43 +491,44 @@ def quantize_int4(
     tensor: torch.Tensor, group_size: int, has_zp: bool
 ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
 
-    # reshape tensor
-    k, n = tensor.shape
-    tensor = tensor.reshape(-1, group_size, n)
-    tensor = tensor.permute(1, 0, 2)
-
-    max_val = torch.max(tensor, 0, keepdim=True).values
-    min_val = torch.min(tensor, 0, keepdim=True).values
+    # reshape tensor, groups are taken along k. Leading dims are batch dims.
+    *batch, k, n = tensor.shape
+    tensor = tensor.reshape(*batch, k // group_size, group_size, n)
 
     # Asymmetric quantization
     zp = None
     if has_zp:
         max_q_val = 15
         min_q_val = 0  # Min maps to 0
-        scale = (max_val - min_val).clamp(min=1e-5) / (max_q_val)
-        zp = torch.round(torch.abs(min_val / scale)).clamp(min_q_val, max_q_val).int()
+        min_val, max_val = torch.aminmax(tensor, dim=-2, keepdim=True)
+        # The range must contain 0 for the zero point to fit in [0, 15]
+        min_val = min_val.clamp(max=0)
+        max_val = max_val.clamp(min=0)
+        scale = (max_val - min_val).clamp(min=1e-5) / max_q_val
+        zp = torch.round(-min_val / scale).clamp(min_q_val, max_q_val).int()
     # Symmetric quantization
     else:
         max_q_val = 7
         min_q_val = -7
-        scale = max_val / max_q_val
+        max_val = tensor.abs().amax(dim=-2, keepdim=True)
+        scale = max_val.clamp(min=1e-5) / max_q_val
 
     # quantize and clamp
     tensor_q = torch.round(tensor / scale).int() + (zp if has_zp else 0)
-    tensor_q = torch.clamp(tensor, min_q_val, max_q_val)
+    tensor_q = torch.clamp(tensor_q, min_q_val, max_q_val)
+    if not has_zp:
+        # Stored as unsigned nibbles, the kernel subtracts the bias of 8
+        tensor_q += 8
 
     # restore shapes
-    tensor_q = tensor_q.reshape((group_size, -1, n))
-    tensor_q = tensor_q.permute(1, 0, 2)
-    tensor_q = tensor_q.reshape((k, n)).contiguous()
+    tensor_q = tensor_q.reshape((*batch, k, n))
 
     # scale
-    scale = scale.reshape((-1, n)).contiguous()
+    scale = scale.reshape((*batch, -1, n))
 
     # zp
     if zp is not None:
-        zp = zp.reshape((-1, n)).contiguous()
-        zp = zp.to(device=tensor.device)
+        zp = zp.reshape((*batch, -1, n))
 
     return tensor_q, scale, zp
 
@@ -468,8 +573,8 @@ def input_helper(
 
     config = moe_config_func(M)
 
-    sorted_token_ids, expert_ids, num_tokens_post_padded = (
-        torch_moe_align_block_size_ref(topk_ids, config["BLOCK_SIZE_M"], E)
+    sorted_token_ids, expert_ids, num_tokens_post_padded = triton_moe_align_block_size(
+        topk_ids, config["BLOCK_SIZE_M"], E
     )
 
     return (
@@ -502,32 +607,27 @@ def input_helper_int4_w4a16(
 ):
 
     a = torch.randn((M, K), dtype=dtype, device="cuda")
-    b = torch.rand((E, N, K), dtype=dtype, device="cuda")
+    # Signed weights, so that groups span zero and exercise the whole nibble
+    # range and non-trivial zero points
+    b = torch.randn((E, N, K), dtype=dtype, device="cuda")
 
-    b_q = torch.empty((E, N, K // 2), dtype=torch.uint8, device="cuda")
-    b_scale = torch.empty((E, N, K // group_size), dtype=dtype, device="cuda")
+    # Quantize all experts at once, groups are taken along K
+    q, scale, zp = quantize_int4(
+        b.transpose(1, 2), group_size=group_size, has_zp=has_zp
+    )
+    q = q.transpose(1, 2)
+    # (E, N, K // 2)
+    b_q = (q[:, :, 1::2] << 4 | q[:, :, ::2]).to(torch.uint8).contiguous()
+    # (E, N, K // group_size)
+    b_scale = scale.transpose(1, 2).contiguous()
     if has_zp:
-        b_zp = torch.empty(
-            (E, N // 2, K // group_size), dtype=torch.uint8, device="cuda"
-        )
+        assert (zp != 0).any(), "all int4 zero points are 0"
+        zp = zp.transpose(1, 2).to(torch.uint8)
+        # (E, N // 2, K // group_size)
+        b_zp = (zp[:, 1::2, :] << 4 | zp[:, ::2, :]).contiguous()
     else:
         b_zp = None
 
-    for e in range(E):
-        q, scale, zp = quantize_int4(b[e].T, group_size=group_size, has_zp=has_zp)
-        q = q.T
-        q = (
-            q[:, 1::2] * 16 + q[:, ::2]
-        )  # Note, 2<<4=16. For bf16, etc, torch doesn't have shift.
-        b_q[e] = q
-        b_scale[e] = scale.T
-        if has_zp:
-            zp = zp.T.contiguous().to(torch.uint8)
-            zp = (
-                zp[1::2, :] << 4 | zp[::2, :]
-            )  # Note, 2<<4=16. For bf16, etc, torch doesn't have shift.
-            b_zp[e] = zp
-
     b = b_q
 
     c = torch.zeros((M, top_k, N), dtype=dtype, device="cuda")
@@ -541,8 +641,8 @@ def input_helper_int4_w4a16(
     moe_config_func = get_optimal_moe_config_func(dtype, use_int4_w4a16=True)
 
     config = moe_config_func(M)
-    sorted_token_ids, expert_ids, num_tokens_post_padded = (
-        torch_moe_align_block_size_ref(topk_ids, config["BLOCK_SIZE_M"], E)
+    sorted_token_ids, expert_ids, num_tokens_post_padded = triton_moe_align_block_size(
+        topk_ids, config["BLOCK_SIZE_M"], E
     )
 
     return (
@@ -571,7 +671,7 @@ def input_helper_e2e(
     dtype,
     fp8_w8a8: bool,
     int8_w8a16: bool,
-    persistent: bool,
+    block_size_m: int,
 ):
     assert not (fp8_w8a8 and int8_w8a16)
 
@@ -597,9 +697,8 @@ def input_helper_e2e(
     softmax_vals = torch.softmax(values, dim=1)
     topk_weights, topk_ids = torch.topk(softmax_vals, k=top_k, dim=1)
 
-    config = get_default_config_moe_e2e(persistent)
-    sorted_token_ids, expert_ids, num_tokens_post_padded = (
-        torch_moe_align_block_size_ref(topk_ids, config["BLOCK_SIZE_M"], E)
+    sorted_token_ids, expert_ids, num_tokens_post_padded = triton_moe_align_block_size(
+        topk_ids, block_size_m, E
     )
 
     return (
@@ -615,10 +714,37 @@ def input_helper_e2e(
         sorted_token_ids,
         expert_ids,
         num_tokens_post_padded,
-        config,
     )
 
 
+@functools.lru_cache(maxsize=1)
+def _cached_input_helper(helper, *args, **kwargs):
+    """
+    Memoizes the last input_helper* call so that parametrizations which only
+    differ in kernel flags (routed_weight, persistent, silu_fused) share the
+    same inputs. These flags are the fastest varying parameters of the tests,
+    so a single entry is enough. The helpers do not use routed_weight, it is
+    kept out of the cache key. The returned tensors are shared, callers must
+    clone the output buffers the kernels write into.
+    """
+    return helper(*args, routed_weight=False, **kwargs)
+
+
+_REF_CACHE = {}
+
+
+@pytest.fixture(scope="module", autouse=True)
+def _clear_input_helper_cache():
+    yield
+    _cached_input_helper.cache_clear()
+    _REF_CACHE.clear()
+    # Hand the cached inputs' memory back before the next test module runs
+    torch.cuda.empty_cache()
+
+
+@pytest.mark.parametrize("silu_fused", [False, True])
+@pytest.mark.parametrize("persistent", [False, True])
+@pytest.mark.parametrize("routed_weight", [False, True])
 # Note: TODO These 2 result in accuracy issues (64, 14336, 4096, 2, 8), (1, 1024, 16384, 1, 2)
 @pytest.mark.parametrize(
     "M, N, K, top_k, E",
@@ -637,12 +763,9 @@ def input_helper_e2e(
         (1, 1024, 16384, 1, 2),
     ],
 )
-@pytest.mark.parametrize("routed_weight", [False, True])
 # @pytest.mark.parametrize('fp8_w8a8, int8_w8a16', [(False, False), (True, False), (False, True)]) #TODO: Accuracy issues with fp8
 @pytest.mark.parametrize("fp8_w8a8, int8_w8a16", [(False, False)])
 @pytest.mark.parametrize("dtype", [torch.float16, torch.bfloat16])
-@pytest.mark.parametrize("persistent", [False, True])
-@pytest.mark.parametrize("silu_fused", [False, True])
 def test_fused_moe(
     M: int,
     N: int,
@@ -657,19 +780,10 @@ def test_fused_moe(
     dtype,
 ):
     torch.manual_seed(20)
-    torch.set_printoptions(threshold=100000)
-    if persistent:
-        (
-            triton_moe_silu_set_use_persistent_kernel(True)
-            if silu_fused
-            else triton_moe_set_use_persistent_kernel(True)
-        )
+    if silu_fused:
+        triton_moe_silu_set_use_persistent_kernel(persistent)
     else:
-        (
-            triton_moe_silu_set_use_persistent_kernel(False)
-            if silu_fused
-            else triton_moe_set_use_persistent_kernel(False)
-        )
+        triton_moe_set_use_persistent_kernel(persistent)
 
     (
         a,
@@ -685,17 +799,18 @@ def test_fused_moe(
         expert_ids,
         num_tokens_post_padded,
         config,
-    ) = input_helper(
+    ) = _cached_input_helper(
+        input_helper,
         M,
         N,
         K,
         top_k,
         E,
-        routed_weight=routed_weight,
         dtype=dtype,
         fp8_w8a8=fp8_w8a8,
         int8_w8a16=int8_w8a16,
     )
+    triton_out, triton_out_silu = triton_out.clone(), triton_out_silu.clone()
 
     if DEBUG_MODE:
         print(f"M={M}, N={N}, K={K}, top_K={top_k}, E={E}")
@@ -765,16 +880,16 @@ def test_fused_moe(
         torch.testing.assert_close(triton_out, torch_out, atol=1e-1, rtol=1e-1)
 
 
+@pytest.mark.parametrize("silu_fused", [False, True])
+@pytest.mark.parametrize("persistent", [False, True])
+@pytest.mark.parametrize("routed_weight", [False, True])
 @pytest.mark.parametrize(
     "M, N, K, top_k, E",
     [(1, 64, 128, 1, 2), (1, 64, 128, 2, 4), (4, 32, 64, 4, 16), (8, 96, 256, 2, 16)],
 )
-@pytest.mark.parametrize("routed_weight", [False, True])
 @pytest.mark.parametrize("group_size", [8, 16, 32, 64])
 @pytest.mark.parametrize("dtype", [torch.bfloat16, torch.float16])
 @pytest.mark.parametrize("has_zp", [False, True])
-@pytest.mark.parametrize("persistent", [False, True])
-@pytest.mark.parametrize("silu_fused", [False, True])
 def test_fused_moe_int4_w4a16(
     M: int,
     N: int,
@@ -817,30 +932,23 @@ def test_fused_moe_int4_w4a16(
         expert_ids,
         num_tokens_post_padded,
         config,
-    ) = input_helper_int4_w4a16(
+    ) = _cached_input_helper(
+        input_helper_int4_w4a16,
         M,
         N,
         K,
         top_k,
         E,
-        routed_weight=routed_weight,
         dtype=dtype,
         group_size=group_size,
         has_zp=has_zp,
     )
+    triton_out, triton_out_silu = triton_out.clone(), triton_out_silu.clone()
 
-    if persistent:
-        (
-            triton_moe_silu_set_use_persistent_kernel(True)
-            if silu_fused
-            else triton_moe_set_use_persistent_kernel(True)
-        )
+    if silu_fused:
+        triton_moe_silu_set_use_persistent_kernel(persistent)
     else:
-        (
-            triton_moe_silu_set_use_persistent_kernel(False)
-            if silu_fused
-            else triton_moe_set_use_persistent_kernel(False)
-        )
+        triton_moe_set_use_persistent_kernel(persistent)
 
     _triton_moe = triton_moe_silu if silu_fused else triton_moe
     _triton_moe(
@@ -896,6 +1004,8 @@ def test_fused_moe_int4_w4a16(
         torch.testing.assert_close(triton_out, torch_out, atol=2e-1, rtol=2e-1)
 
 
+@pytest.mark.parametrize("persistent", [False, True])
+@pytest.mark.parametrize("routed_weight", [False, True])
 # Note: TODO These 2 result in accuracy issues (64, 14336, 4096, 2, 8), (1, 1024, 16384, 1, 2)
 @pytest.mark.parametrize(
     "M, N, K, top_k, E",
@@ -914,11 +1024,9 @@ def test_fused_moe_int4_w4a16(
         (1, 1024, 16384, 1, 2),
     ],
 )
-@pytest.mark.parametrize("routed_weight", [False, True])
 # @pytest.mark.parametrize('fp8_w8a8, int8_w8a16', [(False, False), (True, False), (False, True)]) #TODO: Accuracy issues with fp8
 @pytest.mark.parametrize("fp8_w8a8, int8_w8a16", [(False, False)])
 @pytest.mark.parametrize("dtype", [torch.float16, torch.bfloat16])
-@pytest.mark.parametrize("persistent", [False, True])
 def test_fused_moe_gelu(
     M: int,
     N: int,
@@ -932,11 +1040,7 @@ def test_fused_moe_gelu(
     dtype,
 ):
     torch.manual_seed(20)
-    torch.set_printoptions(threshold=100000)
-    if persistent:
-        triton_moe_gelu_set_use_persistent_kernel(True)
-    else:
-        triton_moe_gelu_set_use_persistent_kernel(False)
+    triton_moe_gelu_set_use_persistent_kernel(persistent)
 
     (
         a,
@@ -952,17 +1056,18 @@ def test_fused_moe_gelu(
         expert_ids,
         num_tokens_post_padded,
         config,
-    ) = input_helper(
+    ) = _cached_input_helper(
+        input_helper,
         M,
         N,
         K,
         top_k,
         E,
-        routed_weight=routed_weight,
         dtype=dtype,
         fp8_w8a8=fp8_w8a8,
         int8_w8a16=int8_w8a16,
     )
+    triton_out = triton_out.clone()
 
     if DEBUG_MODE:
         print(f"M={M}, N={N}, K={K}, top_K={top_k}, E={E}")
@@ -1022,6 +1127,8 @@ def test_fused_moe_gelu(
     torch.testing.assert_close(triton_out, torch_out, atol=1e-1, rtol=1e-1)
 
 
+@pytest.mark.parametrize("persistent", [True, False])
+@pytest.mark.parametrize("routed_weight", [False, True])
 # TODO (64, 7186, 128, 2, 8), (64, 3584, 128, 2, 8), (4, 4, 8, 1, 2), (64, 1792, 128, 2, 8), (64, 64, 128, 2, 8) don't work because of the percision issue with atomics
 @pytest.mark.parametrize(
     "M, N, K, top_k, E",
@@ -1035,12 +1142,10 @@ def test_fused_moe_gelu(
         (1, 1024, 16384, 1, 2),
     ],
 )
-@pytest.mark.parametrize("routed_weight", [False, True])
 # @pytest.mark.parametrize('fp8_w8a8, int8_w8a16', [(False, False), (True, False), (False, True)]) #TODO: Accuracy issues with fp8
 @pytest.mark.parametrize("fp8_w8a8, int8_w8a16", [(False, False)])
 @pytest.mark.parametrize("dtype", [torch.float32, torch.bfloat16])
 # @pytest.mark.parametrize('dtype', [torch.float16, torch.bfloat16])
-@pytest.mark.parametrize("persistent", [True, False])
 def test_moe_e2e(
     M: int,
     N: int,
@@ -1054,11 +1159,7 @@ def test_moe_e2e(
     dtype,
 ):
     torch.manual_seed(20)
-    torch.set_printoptions(threshold=100000)
-    if persistent:
-        triton_e2e_moe_set_use_persistent_kernel(True)
-    else:
-        triton_e2e_moe_set_use_persistent_kernel(False)
+    triton_e2e_moe_set_use_persistent_kernel(persistent)
 
     intermediate = None
     if persistent:
@@ -1066,6 +1167,9 @@ def test_moe_e2e(
             (M * top_k, N // 2), dtype=torch.float32, device="cuda"
         )
 
+    # Only BLOCK_SIZE_M shapes the inputs, so the persistent and
+    # non-persistent variants share them
+    config = get_default_config_moe_e2e(persistent)
     (
         a,
         w1,
@@ -1079,19 +1183,19 @@ def test_moe_e2e(
         sorted_token_ids,
         expert_ids,
         num_tokens_post_padded,
-        config,
-    ) = input_helper_e2e(
+    ) = _cached_input_helper(
+        input_helper_e2e,
         M,
         N,
         K,
         top_k,
         E,
-        routed_weight=routed_weight,
         dtype=dtype,
         fp8_w8a8=fp8_w8a8,
         int8_w8a16=int8_w8a16,
-        persistent=persistent,
+        block_size_m=config["BLOCK_SIZE_M"],
     )
+    triton_out = triton_out.clone()
 
     if DEBUG_MODE:
         print(f"M={M}, N={N}, K={K}, top_K={top_k}, E={E}")
@@ -1104,6 +1208,13 @@ def test_moe_e2e(
         print(f"expert_ids.shape={expert_ids.shape}")
         print(f"expert_ids={expert_ids}")
         print(f"num_tokens_post_padded={num_tokens_post_padded}")
+
+    # The torch reference only reads the inputs, run it on a side stream so
+    # that it overlaps with the Triton kernel
+    main_stream = torch.cuda.current_stream()
+    ref_stream = torch.cuda.Stream()
+    ref_stream.wait_stream(main_stream)
+
     triton_out = triton_e2e_moe(
         a,
         w1,
@@ -1125,22 +1236,28 @@ def test_moe_e2e(
         config,
     )
 
-    torch_out = torch.empty_like(triton_out)
-    torch_out = torch_e2e_moe(
-        a,
-        w1,
-        w2,
-        torch_out,
-        a_scale,
-        w1_scale,
-        w2_scale,
-        topk_ids,
-        topk_weights,
-        routed_weight,
-        dtype,
-        fp8_w8a8,
-        int8_w8a16,
-    )
+    ref_key = (M, N, K, top_k, E, routed_weight, dtype, fp8_w8a8, int8_w8a16)
+    torch_out = _REF_CACHE.get(ref_key)
+    if torch_out is None:
+        with torch.cuda.stream(ref_stream):
+            torch_out = torch_e2e_moe(
+                a,
+                w1,
+                w2,
+                a_scale,
+                w1_scale,
+                w2_scale,
+                topk_ids,
+                topk_weights,
+                routed_weight,
+                dtype,
+                fp8_w8a8,
+                int8_w8a16,
+            )
+        main_stream.wait_stream(ref_stream)
+        torch_out.record_stream(main_stream)
+        if AITER_TEST_REF_CACHE:
+            _REF_CACHE[ref_key] = torch_out
 
     if DEBUG_MODE:
         print(f"triton_out={triton_out}")
@@ -20,18 +20,32 @@ def _torch_moe_align_block_size(
 ) -> None:
     M, top_k = topk_ids.shape
 
+    # Single device->host copy instead of one .item() sync per element
+    topk_ids_list = topk_ids.tolist()
+
     expert_to_tokens = [[] for _ in range(num_experts)]
     # For each token, for each selected expert, we append (token_id, expert)
     for token_id in range(M):
         for j in range(top_k):
-            e_id = topk_ids[token_id, j].item()
+            e_id = topk_ids_list[token_id][j]
             expert_to_tokens[e_id].append(token_id * top_k + j)
 
-    # Reorder tokens block by block, padding if needed
-    reordered_token_ids = []
-    reordered_expert_ids = []
-
+    # Build the outputs in pinned host memory, prefilled with the padding
+    # sentinel, and copy them to the device once, asynchronously
     tot_num_tokens = topk_ids.numel()
+    sorted_token_ids_cpu = torch.full(
+        sorted_token_ids.shape,
+        tot_num_tokens,
+        dtype=sorted_token_ids.dtype,
+        pin_memory=True,
+    )
+    expert_ids_cpu = torch.empty(
+        expert_ids.shape, dtype=expert_ids.dtype, pin_memory=True
+    )
+
+    # Reorder tokens block by block, padding if needed
+    token_length = 0
+    expert_length = 0
     for e_id in range(num_experts):
         tokens_for_expert = expert_to_tokens[e_id]
         num_tokens = len(tokens_for_expert)
@@ -40,31 +54,18 @@ def _torch_moe_align_block_size(
         # If not a multiple of block_size, pad up to the next multiple
         padded_size = n_blocks * block_size
 
-        # Reorder all actual tokens for expert e_id
-        reordered_token_ids.extend(tokens_for_expert)
-        # reordered_expert_ids.extend([e_id]*num_tokens)
-        reordered_expert_ids.extend([e_id] * n_blocks)
+        # Reorder all actual tokens for expert e_id, the padding slots keep
+        # the dummy token_id = tot_num_tokens
+        sorted_token_ids_cpu[token_length : token_length + num_tokens] = torch.tensor(
+            tokens_for_expert, dtype=sorted_token_ids.dtype
+        )
+        expert_ids_cpu[expert_length : expert_length + n_blocks] = e_id
 
-        # Pad with dummy token_id = -1 (or any sentinel), if needed
-        if padded_size > num_tokens:
-            pad_count = padded_size - num_tokens
-            reordered_token_ids.extend([tot_num_tokens] * pad_count)
+        token_length += padded_size
+        expert_length += n_blocks
 
-    token_length = len(reordered_token_ids)
-    expert_length = len(reordered_expert_ids)
-
-    sorted_token_ids[:token_length] = torch.tensor(
-        reordered_token_ids,
-        dtype=sorted_token_ids.dtype,
-        device=sorted_token_ids.device,
-    )
-    expert_ids[:expert_length] = torch.tensor(
-        reordered_expert_ids, dtype=expert_ids.dtype, device=expert_ids.device
-    )
-
-    # Fill remainder with -1 if these arrays are bigger than total_length
-    if token_length < sorted_token_ids.numel():
-        sorted_token_ids[token_length:] = tot_num_tokens
+    sorted_token_ids.copy_(sorted_token_ids_cpu, non_blocking=True)
+    expert_ids[:expert_length].copy_(expert_ids_cpu[:expert_length], non_blocking=True)
 
     num_tokens_post_pad.fill_(token_length)
 
@@ -157,6 +158,10 @@ def test_correctness(M: int, E: int, top_k: int, block_size: int):
         torch_moe_align_block_size(topk_ids, E, block_size)
     )
 
-    torch.eq(tri_sorted_ids, torch_sorted_ids)
-    torch.eq(tri_num_tokens_post_pad, torch_num_tokens_post_pad)
-    torch.eq(tri_expert_ids[:E], torch_expert_ids[:E])
+    torch.testing.assert_close(tri_num_tokens_post_pad, torch_num_tokens_post_pad)
+    torch.testing.assert_close(tri_sorted_ids, torch_sorted_ids)
+    # Only the first num_tokens_post_pad // block_size expert ids are written
+    num_blocks = torch_num_tokens_post_pad.item() // block_size
+    torch.testing.assert_close(
+        tri_expert_ids[:num_blocks], torch_expert_ids[:num_blocks]
+    )